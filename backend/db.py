@@ -1,17 +1,59 @@
+import hashlib
+import os
 import sqlite3
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Iterable
+from typing import Iterable, Iterator
 
 DB_PATH = Path("evernote.db")
+ATTACHMENTS_DIR = Path("attachments")
 
 
-def get_connection(db_path: Path = DB_PATH) -> sqlite3.Connection:
-    conn = sqlite3.connect(db_path)
+def get_connection(db_path: Path = DB_PATH, check_same_thread: bool = True) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_path, check_same_thread=check_same_thread)
     conn.row_factory = sqlite3.Row
+    # page_size only takes effect on a fresh database, so it must precede the switch to WAL.
+    conn.execute("PRAGMA page_size = 8192;")
+    conn.execute("PRAGMA journal_mode = WAL;")
+    conn.execute("PRAGMA synchronous = NORMAL;")
+    conn.execute("PRAGMA temp_store = MEMORY;")
+    conn.execute("PRAGMA mmap_size = 268435456;")
+    conn.execute("PRAGMA cache_size = -200000;")
+    conn.execute("PRAGMA wal_autocheckpoint = 10000;")
     conn.execute("PRAGMA foreign_keys = ON;")
     return conn
 
 
+def get_read_connection(db_path: Path = DB_PATH, check_same_thread: bool = True) -> sqlite3.Connection:
+    """
+    Open a read-only connection; the database must already exist (see init_db).
+    """
+    conn = sqlite3.connect(
+        f"{Path(db_path).resolve().as_uri()}?mode=ro", uri=True, check_same_thread=check_same_thread
+    )
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA query_only = ON;")
+    conn.execute("PRAGMA temp_store = MEMORY;")
+    conn.execute("PRAGMA mmap_size = 268435456;")
+    conn.execute("PRAGMA cache_size = -200000;")
+    return conn
+
+
+@contextmanager
+def bulk_import(conn: sqlite3.Connection) -> Iterator[sqlite3.Connection]:
+    """
+    Relax durability and FK checks for the duration of a bulk import.
+    Must be entered outside a transaction; PRAGMAs are restored on exit.
+    """
+    conn.execute("PRAGMA synchronous = OFF;")
+    conn.execute("PRAGMA foreign_keys = OFF;")
+    try:
+        yield conn
+    finally:
+        conn.execute("PRAGMA foreign_keys = ON;")
+        conn.execute("PRAGMA synchronous = NORMAL;")
+
+
 def init_db(conn: sqlite3.Connection) -> None:
     conn.executescript(
         """
@@ -29,16 +71,22 @@ def init_db(conn: sqlite3.Connection) -> None:
             imported_at INTEGER
         );
 
+        -- Matches the list_notes ORDER BY so pages and keyset cursors walk the index.
+        CREATE INDEX IF NOT EXISTS idx_notes_sort ON notes(COALESCE(updated_at, created_at, 0) DESC, id DESC);
+
         CREATE TABLE IF NOT EXISTS resources (
             id INTEGER PRIMARY KEY,
             note_id INTEGER NOT NULL,
             mime TEXT,
             filename TEXT,
-            data BLOB,
+            path TEXT,
+            size INTEGER,
             hash TEXT,
             FOREIGN KEY(note_id) REFERENCES notes(id) ON DELETE CASCADE
         );
 
+        CREATE INDEX IF NOT EXISTS idx_resources_note_id ON resources(note_id);
+
         CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts
         USING fts5(
             title,
@@ -47,7 +95,61 @@ def init_db(conn: sqlite3.Connection) -> None:
             content_rowid='id',
             tokenize='unicode61'
         );
+        """
+    )
+    _migrate_resource_blobs(conn)
+    create_fts_triggers(conn)
+
 
+def _migrate_resource_blobs(conn: sqlite3.Connection) -> None:
+    # Databases created before attachments moved to disk keep them in resources.data.
+    # Each step is safe to repeat, so an interrupted migration resumes on the next startup.
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(resources);")}
+    if "data" not in columns:
+        return
+    if "path" not in columns:
+        conn.execute("ALTER TABLE resources ADD COLUMN path TEXT;")
+    if "size" not in columns:
+        conn.execute("ALTER TABLE resources ADD COLUMN size INTEGER;")
+    ids = [
+        row[0] for row in conn.execute("SELECT id FROM resources WHERE data IS NOT NULL AND path IS NULL;")
+    ]
+    with conn:
+        for resource_id in ids:
+            data = conn.execute("SELECT data FROM resources WHERE id = ?", (resource_id,)).fetchone()[0]
+            conn.execute(
+                "UPDATE resources SET path = ?, size = ?, data = NULL WHERE id = ?",
+                (store_attachment(data), len(data), resource_id),
+            )
+    # Every row has a path now; drop the emptied column and give the space back.
+    # Requires SQLite 3.35+, as does the RETURNING used by the importer.
+    conn.execute("ALTER TABLE resources DROP COLUMN data;")
+    conn.execute("VACUUM;")
+
+
+def store_attachment(data: bytes, attachments_dir: Path = ATTACHMENTS_DIR) -> str:
+    """
+    Write an attachment under its SHA-256 and return the path relative to attachments_dir.
+    Identical payloads share one file.
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    rel_path = f"{digest[:2]}/{digest}"
+    dest = attachments_dir / rel_path
+    if not dest.exists():
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        tmp = dest.with_name(f"{digest}.{os.getpid()}.tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, dest)
+    return rel_path
+
+
+def attachment_path(rel_path: str, attachments_dir: Path = ATTACHMENTS_DIR) -> Path:
+    return attachments_dir / rel_path
+
+
+def create_fts_triggers(conn: sqlite3.Connection) -> None:
+    conn.executescript(
+        """
         CREATE TRIGGER IF NOT EXISTS notes_ai AFTER INSERT ON notes BEGIN
             INSERT INTO notes_fts(rowid, title, text) VALUES (new.id, new.title, new.text);
         END;
@@ -64,5 +166,23 @@ def init_db(conn: sqlite3.Connection) -> None:
     )
 
 
+def drop_fts_triggers(conn: sqlite3.Connection) -> None:
+    conn.execute("DROP TRIGGER IF EXISTS notes_ai;")
+    conn.execute("DROP TRIGGER IF EXISTS notes_au;")
+    conn.execute("DROP TRIGGER IF EXISTS notes_ad;")
+
+
+@contextmanager
+def fts_triggers_dropped(conn: sqlite3.Connection) -> Iterator[sqlite3.Connection]:
+    """
+    Suspend the notes_fts sync triggers; the caller keeps notes_fts in step itself.
+    """
+    drop_fts_triggers(conn)
+    try:
+        yield conn
+    finally:
+        create_fts_triggers(conn)
+
+
 def executemany(conn: sqlite3.Connection, query: str, rows: Iterable[tuple]) -> None:
     conn.executemany(query, rows)
@@ -1,14 +1,23 @@
-import base64
-import json
+import calendar
+import os
+import re
 import sqlite3
 import hashlib
+import multiprocessing
 import time
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass, field
 from datetime import datetime
-from html.parser import HTMLParser
 from pathlib import Path
-from typing import Iterable, List, Optional
-from xml.etree import ElementTree as ET
+from queue import Empty, Full
+from typing import BinaryIO, Iterable, List, Optional, Tuple
+
+import orjson
+import pybase64
+from lxml import etree as ET
+from selectolax.lexbor import LexborHTMLParser
+
+from . import db
 
 
 @dataclass
@@ -17,6 +26,9 @@ class Resource:
     filename: Optional[str] = None
     data: bytes = b""
     hash: Optional[str] = None
+    # Set once data has been written to the attachment store (see db.store_attachment).
+    path: Optional[str] = None
+    size: Optional[int] = None
 
 
 @dataclass
@@ -32,181 +44,328 @@ class Note:
     source_file: str = ""
 
 
-class TextExtractor(HTMLParser):
-    def __init__(self) -> None:
-        super().__init__()
-        self.parts: List[str] = []
+# Notes buffered per executemany flush during import.
+IMPORT_BATCH_SIZE = 1000
+# Parsed batches a worker may queue ahead of the writer, per file.
+QUEUED_BATCHES_PER_FILE = 2
+QUEUE_POLL_SECONDS = 1.0
+# Keeps IN (...) lists under SQLite's host parameter limit.
+SQL_VARIABLE_CHUNK = 500
+
+_WHITESPACE = re.compile(r"\s+")
 
-    def handle_data(self, data: str) -> None:
-        if data and data.strip():
-            self.parts.append(data.strip())
 
-    def get_text(self) -> str:
-        return " ".join(self.parts)
+def _timestamp_fields(raw: Optional[str]) -> Optional[Tuple[int, int, int, int, int, int]]:
+    # ENEX timestamps are fixed-width UTC: YYYYMMDDTHHMMSSZ.
+    if not raw:
+        return None
+    s = raw.strip()
+    if len(s) != 16 or s[8] != "T" or s[15] != "Z" or not (s[0:8] + s[9:15]).isdigit():
+        return None
+    year, month, day = int(s[0:4]), int(s[4:6]), int(s[6:8])
+    hour, minute, second = int(s[9:11]), int(s[11:13]), int(s[13:15])
+    if year < 1 or not (1 <= month <= 12 and 1 <= day <= calendar.monthrange(year, month)[1]):
+        return None
+    if hour > 23 or minute > 59 or second > 59:
+        return None
+    return year, month, day, hour, minute, second
 
 
 def parse_timestamp(raw: Optional[str]) -> Optional[int]:
-    if not raw:
+    fields = _timestamp_fields(raw)
+    if fields is None:
+        return None
+    return calendar.timegm(fields + (0, 0, 0))
+
+
+def _legacy_timestamp(raw: Optional[str]) -> Optional[int]:
+    # Older releases read ENEX timestamps as host-local time. Surrogate GUIDs were
+    # derived from those values, so keep feeding derive_guid the same numbers.
+    fields = _timestamp_fields(raw)
+    if fields is None:
         return None
     try:
-        dt = datetime.strptime(raw.strip(), "%Y%m%dT%H%M%SZ")
-        return int(dt.timestamp())
-    except Exception:
+        return int(datetime(*fields).timestamp())
+    except (OverflowError, OSError, ValueError):
         return None
 
 
 def extract_text_from_html(html: str) -> str:
-    parser = TextExtractor()
-    parser.feed(html)
-    return parser.get_text()
+    if not html or not html.strip():
+        return ""
+    body = LexborHTMLParser(html).body
+    text = body.text(separator=" ", strip=True) if body is not None else ""
+    return _WHITESPACE.sub(" ", text).strip()
 
 
 def parse_enex(file_path: Path, source_file: str) -> Iterable[Note]:
     """
     Stream parse an ENEX file and yield Note objects.
     """
-    context = ET.iterparse(file_path, events=("end",))
-    for event, elem in context:
-        if elem.tag != "note":
-            continue
+    with open(file_path, "rb") as fh:
+        yield from parse_enex_stream(fh, source_file)
+
+
+def parse_enex_stream(fh: BinaryIO, source_file: str) -> Iterable[Note]:
+    """
+    Stream parse ENEX from an open binary file object and yield Note objects.
+    """
+    context = ET.iterparse(fh, events=("end",), tag="note", huge_tree=True, recover=False)
+    try:
+        for event, elem in context:
+            yield _note_from_elem(elem, source_file)
+
+            # free memory, including the emptied siblings still hanging off the root
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+    finally:
+        del context
+
+
+def _note_from_elem(elem, source_file: str) -> Note:
+    # One pass over the note's children instead of a findtext/find scan per field.
+    raw_guid = title = html = ""
+    created_raw = updated_raw = None
+    tags: List[str] = []
+    resources: List[Resource] = []
+    for child in elem:
+        tag = child.tag
+        if tag == "title":
+            title = (child.text or "").strip()
+        elif tag == "content":
+            html = child.text or ""
+        elif tag == "tag":
+            if child.text:
+                tags.append(child.text.strip())
+        elif tag == "resource":
+            resources.append(_parse_resource(child))
+        elif tag == "created":
+            created_raw = child.text
+        elif tag == "updated":
+            updated_raw = child.text
+        elif tag == "guid":
+            raw_guid = (child.text or "").strip()
+
+    created_at = parse_timestamp(created_raw)
+    updated_at = parse_timestamp(updated_raw)
+    text = extract_text_from_html(html)
+    if raw_guid:
+        guid = raw_guid
+    else:
+        guid = derive_guid("", title, _legacy_timestamp(created_raw), _legacy_timestamp(updated_raw), html)
+    return Note(
+        guid=guid,
+        title=title,
+        created_at=created_at,
+        updated_at=updated_at,
+        tags=tags,
+        html=html,
+        text=text,
+        resources=resources,
+        source_file=source_file,
+    )
 
-        raw_guid = (elem.findtext("guid") or "").strip()
-        title = (elem.findtext("title") or "").strip()
-        created_at = parse_timestamp(elem.findtext("created"))
-        updated_at = parse_timestamp(elem.findtext("updated"))
-        tags = [t.text.strip() for t in elem.findall("tag") if t.text]
-
-        content_elem = elem.find("content")
-        html = content_elem.text or ""
-        text = extract_text_from_html(html)
-
-        resources: List[Resource] = []
-        for res_elem in elem.findall("resource"):
-            data_elem = res_elem.find("data")
-            data = b""
-            if data_elem is not None and data_elem.text:
+
+def _parse_resource(res_elem) -> Resource:
+    data = b""
+    mime = filename = hash_text = None
+    for child in res_elem:
+        tag = child.tag
+        if tag == "data":
+            if child.text:
                 try:
-                    data = base64.b64decode(data_elem.text, validate=False)
+                    data = pybase64.b64decode(child.text.encode("ascii"), validate=False)
                 except Exception:
                     data = b""
-            mime = res_elem.findtext("mime")
-            attrs = res_elem.find("resource-attributes")
-            filename = attrs.findtext("file-name") if attrs is not None else None
-            hash_elem = res_elem.find("recognition")
-            resources.append(
-                Resource(
-                    mime=mime.strip() if mime else None,
-                    filename=filename.strip() if filename else None,
-                    data=data,
-                    hash=hash_elem.text.strip() if hash_elem is not None and hash_elem.text else None,
-                )
-            )
-
-        guid = derive_guid(raw_guid, title, created_at, updated_at, html)
-        yield Note(
-            guid=guid,
-            title=title,
-            created_at=created_at,
-            updated_at=updated_at,
-            tags=tags,
-            html=html,
-            text=text,
-            resources=resources,
-            source_file=source_file,
-        )
-
-        # free memory
-        elem.clear()
+        elif tag == "mime":
+            mime = child.text
+        elif tag == "resource-attributes":
+            for attr in child:
+                if attr.tag == "file-name":
+                    filename = attr.text
+                    break
+        elif tag == "recognition":
+            hash_text = child.text
+    return Resource(
+        mime=mime.strip() if mime else None,
+        filename=filename.strip() if filename else None,
+        data=data,
+        hash=hash_text.strip() if hash_text else None,
+    )
 
 
 def derive_guid(raw_guid: str, title: str, created_at: Optional[int], updated_at: Optional[int], html: str) -> str:
     if raw_guid:
         return raw_guid
     # Create a deterministic surrogate ID based on note contents and timestamps.
-    hasher = hashlib.sha1()
-    hasher.update((title or "").encode("utf-8"))
-    hasher.update(str(created_at or "").encode("utf-8"))
-    hasher.update(str(updated_at or "").encode("utf-8"))
-    hasher.update((html or "").encode("utf-8"))
-    return hasher.hexdigest()
+    # The digest is stored as the note's GUID, so the algorithm must stay SHA-1
+    # for re-imports to keep matching existing rows.
+    buf = "".join((title or "", str(created_at or ""), str(updated_at or ""), html or "")).encode("utf-8")
+    return hashlib.sha1(buf).hexdigest()
+
+
+_SQL_UPSERT = """
+    INSERT INTO notes (guid, title, created_at, updated_at, tags_json, html, text, source_file, resource_count, imported_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(guid) DO UPDATE SET
+        title = excluded.title,
+        created_at = excluded.created_at,
+        updated_at = excluded.updated_at,
+        tags_json = excluded.tags_json,
+        html = excluded.html,
+        text = excluded.text,
+        source_file = excluded.source_file,
+        resource_count = excluded.resource_count,
+        imported_at = excluded.imported_at
+"""
+_SQL_UPSERT_RETURNING = _SQL_UPSERT + "RETURNING id\n"
+_SQL_DELETE_RES = "DELETE FROM resources WHERE note_id = ?"
+_SQL_INSERT_RES = """
+    INSERT INTO resources (note_id, mime, filename, path, size, hash)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+
+def _note_values(note: Note, imported_at: int) -> tuple:
+    # _SQL_UPSERT column order after guid.
+    return (
+        note.title,
+        note.created_at,
+        note.updated_at,
+        orjson.dumps(note.tags).decode() if note.tags else "[]",
+        note.html,
+        note.text,
+        note.source_file,
+        len(note.resources),
+        imported_at,
+    )
+
+
+class NoteWriter:
+    """
+    Row-by-row upsert that reuses one cursor and the module-level statements.
+
+    Create one writer per connection and keep it for the whole write session;
+    the cursor and the insert/update bookkeeping are set up once in __init__.
+    Notes added to the table by anything other than this writer while it is
+    alive would be reported as 'inserted' when it later updates them.
+    """
+
+    def __init__(self, conn: sqlite3.Connection) -> None:
+        self.cur = conn.cursor()
+        # New rows are assigned a rowid above every existing one, which is how
+        # write() tells an insert from a conflict update without a lookup per note.
+        self.max_id = self.cur.execute("SELECT COALESCE(MAX(id), 0) FROM notes").fetchone()[0]
+
+    def write(self, note: Note, imported_at: int) -> str:
+        """
+        Insert or update a note by GUID. Returns 'inserted' or 'updated'.
+        """
+        cur = self.cur
+        note_id = cur.execute(_SQL_UPSERT_RETURNING, (note.guid,) + _note_values(note, imported_at)).fetchone()[0]
+        if note_id > self.max_id:
+            self.max_id = note_id
+            status = "inserted"
+        else:
+            cur.execute(_SQL_DELETE_RES, (note_id,))
+            status = "updated"
+
+        if note.resources:
+            cur.executemany(_SQL_INSERT_RES, _resource_rows(note_id, note.resources))
+        return status
 
 
 def upsert_note(conn: sqlite3.Connection, note: Note, imported_at: int) -> str:
     """
-    Insert or update a note by GUID. Returns 'inserted' or 'updated'.
-    """
-    cur = conn.cursor()
-    cur.execute("SELECT id FROM notes WHERE guid = ?", (note.guid,))
-    row = cur.fetchone()
-    tags_json = json.dumps(note.tags)
-    resource_count = len(note.resources)
-
-    if row:
-        note_id = row["id"]
-        cur.execute(
-            """
-            UPDATE notes SET
-                title = ?,
-                created_at = ?,
-                updated_at = ?,
-                tags_json = ?,
-                html = ?,
-                text = ?,
-                source_file = ?,
-                resource_count = ?,
-                imported_at = ?
-            WHERE id = ?
-            """,
-            (
-                note.title,
-                note.created_at,
-                note.updated_at,
-                tags_json,
-                note.html,
-                note.text,
-                note.source_file,
-                resource_count,
-                imported_at,
-                note_id,
-            ),
-        )
-        cur.execute("DELETE FROM resources WHERE note_id = ?", (note_id,))
-        status = "updated"
-    else:
-        cur.execute(
-            """
-            INSERT INTO notes (guid, title, created_at, updated_at, tags_json, html, text, source_file, resource_count, imported_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    Insert or update a single note by GUID. Returns 'inserted' or 'updated'.
+
+    Kept for one-off writes: it builds a NoteWriter per call, so callers writing
+    notes in a loop should hold one NoteWriter instead (or use upsert_notes).
+    """
+    return NoteWriter(conn).write(note, imported_at)
+
+
+def _store_resource(res: Resource) -> None:
+    if res.path is None:
+        res.path = db.store_attachment(res.data)
+        res.size = len(res.data)
+        res.data = b""
+
+
+def _resource_rows(note_id: int, resources: List[Resource]) -> List[tuple]:
+    # Payloads go to the attachment store; only the path and metadata stay in SQLite.
+    rows = []
+    for res in resources:
+        _store_resource(res)
+        rows.append((note_id, res.mime, res.filename, res.path, res.size, res.hash))
+    return rows
+
+
+def _chunks(items: List, size: int) -> Iterable[List]:
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+def _note_ids_by_guid(conn: sqlite3.Connection, guids: List[str]) -> dict:
+    ids = {}
+    for chunk in _chunks(guids, SQL_VARIABLE_CHUNK):
+        placeholders = ", ".join("?" * len(chunk))
+        for row in conn.execute(f"SELECT id, guid FROM notes WHERE guid IN ({placeholders})", chunk):
+            ids[row[1]] = row[0]
+    return ids
+
+
+def upsert_notes(conn: sqlite3.Connection, notes: List[Note], imported_at: int) -> tuple:
+    """
+    Insert or update a batch of notes by GUID. Returns (inserted, updated) counts.
+
+    notes_fts is maintained here directly, so the sync triggers must be dropped
+    (see db.fts_triggers_dropped) while this runs.
+    """
+    # Later occurrences of a GUID within the batch win, as with repeated upsert_note calls.
+    latest = {}
+    for note in notes:
+        latest[note.guid] = note
+    existing = _note_ids_by_guid(conn, list(latest))
+    inserted = len(latest) - len(existing)
+    updated = len(notes) - inserted
+
+    new_guids = [guid for guid in latest if guid not in existing]
+
+    # Remove the stale FTS rows while notes still holds the old title/text.
+    for chunk in _chunks(list(existing.values()), SQL_VARIABLE_CHUNK):
+        placeholders = ", ".join("?" * len(chunk))
+        conn.execute(
+            f"""
+            INSERT INTO notes_fts(notes_fts, rowid, title, text)
+            SELECT 'delete', id, title, text FROM notes WHERE id IN ({placeholders})
             """,
-            (
-                note.guid,
-                note.title,
-                note.created_at,
-                note.updated_at,
-                tags_json,
-                note.html,
-                note.text,
-                note.source_file,
-                resource_count,
-                imported_at,
-            ),
+            chunk,
         )
-        note_id = cur.lastrowid
-        status = "inserted"
-
-    if note.resources:
-        cur.executemany(
-            """
-            INSERT INTO resources (note_id, mime, filename, data, hash)
-            VALUES (?, ?, ?, ?, ?)
-            """,
-            [
-                (note_id, res.mime, res.filename, res.data, res.hash)
-                for res in note.resources
-            ],
+
+    conn.executemany(_SQL_UPSERT, ((note.guid,) + _note_values(note, imported_at) for note in latest.values()))
+
+    for chunk in _chunks(list(existing.values()), SQL_VARIABLE_CHUNK):
+        placeholders = ", ".join("?" * len(chunk))
+        conn.execute(f"DELETE FROM resources WHERE note_id IN ({placeholders})", chunk)
+
+    note_ids = dict(existing)
+    if new_guids:
+        note_ids.update(_note_ids_by_guid(conn, new_guids))
+    conn.executemany(
+        _SQL_INSERT_RES,
+        (row for note in latest.values() for row in _resource_rows(note_ids[note.guid], note.resources)),
+    )
+
+    for chunk in _chunks(list(note_ids.values()), SQL_VARIABLE_CHUNK):
+        placeholders = ", ".join("?" * len(chunk))
+        conn.execute(
+            f"INSERT INTO notes_fts(rowid, title, text) SELECT id, title, text FROM notes WHERE id IN ({placeholders})",
+            chunk,
         )
 
-    return status
+    return inserted, updated
 
 
 def import_enex_file(conn: sqlite3.Connection, file_path: Path, source_name: Optional[str] = None) -> dict:
@@ -214,19 +373,133 @@ def import_enex_file(conn: sqlite3.Connection, file_path: Path, source_name: Opt
     Import a single ENEX file; returns stats dict.
     """
     source_file = source_name or file_path.name
-    inserted = updated = skipped = 0
     started = time.time()
-    imported_at = int(started)
+    return _import_notes(conn, parse_enex(file_path, source_file=source_file), source_file, started)
+
+
+def import_enex_stream(conn: sqlite3.Connection, fh: BinaryIO, source_name: str) -> dict:
+    """
+    Import ENEX read from an open binary file object; returns stats dict.
+    """
+    started = time.time()
+    return _import_notes(conn, parse_enex_stream(fh, source_file=source_name), source_name, started)
+
+
+def import_enex_files(conn: sqlite3.Connection, files: List[Tuple[Path, str]]) -> List[dict]:
+    """
+    Import several ENEX files given as (path, source name) pairs; returns one stats dict per file.
+    Files are parsed in worker processes while this process does all the SQLite writes.
+    """
+    workers = min(len(files), max(1, (os.cpu_count() or 1) - 1))
+    if workers <= 1:
+        return [import_enex_file(conn, file_path, source_name) for file_path, source_name in files]
+
+    # spawn: forking a threaded server that holds open SQLite connections is unsafe.
+    ctx = multiprocessing.get_context("spawn")
+    queues = [ctx.Queue(maxsize=QUEUED_BATCHES_PER_FILE) for _ in files]
+    stop = ctx.Event()
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=ctx, initializer=_init_parse_worker, initargs=(queues, stop)
+    ) as pool:
+        futures = [
+            pool.submit(_parse_enex_file, index, file_path, source_name)
+            for index, (file_path, source_name) in enumerate(files)
+        ]
+        results = []
+        try:
+            # Files are written one transaction at a time, in upload order; workers
+            # ahead of the writer block once their file's queue is full.
+            for queue, future, (_, source_name) in zip(queues, futures, files):
+                results.append(_import_notes(conn, _drain_batches(queue, future), source_name, time.time()))
+        except BaseException:
+            stop.set()
+            for future in futures:
+                future.cancel()
+            raise
+        return results
 
-    with conn:
+
+_parse_queues: list = []
+_parse_stop = None
+
+
+def _init_parse_worker(queues: list, stop) -> None:
+    global _parse_queues, _parse_stop
+    _parse_queues = queues
+    _parse_stop = stop
+    # Don't block worker exit on batches the writer abandoned after an error.
+    for queue in queues:
+        queue.cancel_join_thread()
+
+
+def _parse_enex_file(index: int, file_path: Path, source_file: str) -> None:
+    # Worker entry point: sends notes back in IMPORT_BATCH_SIZE batches, then None.
+    # Attachments are written to the store here so only their paths are pickled.
+    queue = _parse_queues[index]
+    try:
+        batch: List[Note] = []
         for note in parse_enex(file_path, source_file=source_file):
-            status = upsert_note(conn, note, imported_at)
-            if status == "inserted":
-                inserted += 1
-            elif status == "updated":
-                updated += 1
-            else:
-                skipped += 1
+            for res in note.resources:
+                _store_resource(res)
+            batch.append(note)
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                if not _put_batch(queue, batch):
+                    return
+                batch = []
+        if batch:
+            _put_batch(queue, batch)
+    except Exception as exc:
+        # lxml errors carry an unpicklable error log; hand back the message instead.
+        raise ValueError(f"{source_file}: {exc}") from None
+    finally:
+        _put_batch(queue, None)
+
+
+def _put_batch(queue, batch: Optional[List[Note]]) -> bool:
+    # Returns False if the writer gave up while this worker was waiting for room.
+    while not _parse_stop.is_set():
+        try:
+            queue.put(batch, timeout=QUEUE_POLL_SECONDS)
+            return True
+        except Full:
+            continue
+    return False
+
+
+def _drain_batches(queue, future) -> Iterable[Note]:
+    while True:
+        try:
+            batch = queue.get(timeout=QUEUE_POLL_SECONDS)
+        except Empty:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+            continue
+        if batch is None:
+            future.result()  # re-raise a parse error from the worker
+            return
+        yield from batch
+
+
+def _import_notes(conn: sqlite3.Connection, notes: Iterable[Note], source_file: str, started: float) -> dict:
+    inserted = updated = skipped = 0
+    imported_at = int(started)
+
+    with db.bulk_import(conn), db.fts_triggers_dropped(conn), conn:
+        batch: List[Note] = []
+        for note in notes:
+            # Spill attachments now so a buffered batch holds paths, not payloads.
+            for res in note.resources:
+                _store_resource(res)
+            batch.append(note)
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                batch_inserted, batch_updated = upsert_notes(conn, batch, imported_at)
+                inserted += batch_inserted
+                updated += batch_updated
+                batch = []
+        if batch:
+            batch_inserted, batch_updated = upsert_notes(conn, batch, imported_at)
+            inserted += batch_inserted
+            updated += batch_updated
 
     duration_ms = int((time.time() - started) * 1000)
     return {
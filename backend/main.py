@@ -1,24 +1,57 @@
+import asyncio
+import shutil
+import threading
+from contextlib import ExitStack
 from typing import List, Optional
 import sqlite3
 from tempfile import NamedTemporaryFile
 from pathlib import Path
-import json
 
+import orjson
 from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import FileResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 
 from . import db
-from .importer import import_enex_file
+from .importer import import_enex_files, import_enex_stream
 
-app = FastAPI(title="Evernote Exporter")
+
+class OrjsonResponse(JSONResponse):
+    # Local equivalent of fastapi's ORJSONResponse, which newer releases deprecate.
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+
+app = FastAPI(title="Evernote Exporter", default_response_class=OrjsonResponse)
+
+MAX_LIST_LIMIT = 500
+UPLOAD_COPY_CHUNK = 8 * 1024 * 1024
+
+# One read-only connection per threadpool worker, opened on first use.
+_read_local = threading.local()
 
 
 @app.on_event("startup")
 def startup_event() -> None:
-    conn = db.get_connection()
+    # Imports share one write connection; the lock keeps them from interleaving.
+    conn = db.get_connection(check_same_thread=False)
     db.init_db(conn)
-    conn.close()
+    app.state.write_conn = conn
+    app.state.write_lock = asyncio.Lock()
+
+
+@app.on_event("shutdown")
+def shutdown_event() -> None:
+    app.state.write_conn.close()
+
+
+def read_connection() -> sqlite3.Connection:
+    conn = getattr(_read_local, "conn", None)
+    if conn is None:
+        conn = db.get_read_connection()
+        _read_local.conn = conn
+    return conn
 
 
 @app.get("/api/health")
@@ -31,55 +64,77 @@ async def import_upload(files: List[UploadFile] = File(...)) -> dict:
     if not files:
         raise HTTPException(status_code=400, detail="No files uploaded")
 
-    conn = db.get_connection()
-    results = []
     for upload in files:
         if not upload.filename.lower().endswith(".enex"):
             raise HTTPException(status_code=400, detail=f"Unsupported file: {upload.filename}")
-        with NamedTemporaryFile(delete=True) as tmp:
-            await _copy_upload(upload, tmp.name)
-            stats = import_enex_file(conn, Path(tmp.name), source_name=upload.filename)
-            stats["original_name"] = upload.filename
-            results.append(stats)
 
-    conn.close()
+    if len(files) == 1:
+        # A single file is parsed straight from the upload's spooled temp file.
+        upload = files[0]
+        await upload.seek(0)
+        async with app.state.write_lock:
+            results = [await run_in_threadpool(import_enex_stream, app.state.write_conn, upload.file, upload.filename)]
+    else:
+        # Worker processes need named files to open.
+        with ExitStack() as stack:
+            staged = []
+            for upload in files:
+                tmp = stack.enter_context(NamedTemporaryFile(delete=True))
+                await run_in_threadpool(_copy_upload, upload, tmp)
+                staged.append((Path(tmp.name), upload.filename))
+
+            async with app.state.write_lock:
+                results = await run_in_threadpool(import_enex_files, app.state.write_conn, staged)
+
+    for stats, upload in zip(results, files):
+        stats["original_name"] = upload.filename
     return {"imports": results}
 
 
-async def _copy_upload(upload: UploadFile, dest_path: str) -> None:
-    with open(dest_path, "wb") as dest:
-        while True:
-            chunk = await upload.read(1024 * 1024)
-            if not chunk:
-                break
-            dest.write(chunk)
+def _copy_upload(upload: UploadFile, dest) -> None:
+    upload.file.seek(0)
+    shutil.copyfileobj(upload.file, dest, length=UPLOAD_COPY_CHUNK)
+    dest.flush()
 
 
 @app.get("/api/notes")
-def list_notes(limit: int = 0, offset: int = 0) -> dict:
-    conn = db.get_connection()
-    cur = conn.cursor()
-    if limit and limit > 0:
-        cur.execute(
-            """
-            SELECT id, guid, title, created_at, updated_at, tags_json, source_file, resource_count
-            FROM notes
-            ORDER BY COALESCE(updated_at, created_at) DESC, id DESC
-            LIMIT ? OFFSET ?
-            """,
-            (limit, offset),
-        )
-    else:
-        cur.execute(
-            """
-            SELECT id, guid, title, created_at, updated_at, tags_json, source_file, resource_count
-            FROM notes
-            ORDER BY COALESCE(updated_at, created_at) DESC, id DESC
-            """
-        )
-    rows = cur.fetchall()
-    conn.close()
-    return {"notes": [note_from_row(row) for row in rows]}
+def list_notes(limit: int = MAX_LIST_LIMIT, offset: int = 0, cursor: Optional[str] = None, fields: str = ""):
+    if limit <= 0 or limit > MAX_LIST_LIMIT:
+        limit = MAX_LIST_LIMIT
+    include_tags = "tags" in fields.split(",")
+
+    where = ""
+    params: list = []
+    if cursor:
+        try:
+            sort_key, last_id = (int(part) for part in cursor.split(":", 1))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        # The leading bound lets SQLite seek into idx_notes_sort; the row value breaks ties.
+        where = """
+        WHERE COALESCE(updated_at, created_at, 0) <= ?
+            AND (COALESCE(updated_at, created_at, 0), id) < (?, ?)
+        """
+        params = [sort_key, sort_key, last_id]
+
+    # A page is capped at MAX_LIST_LIMIT rows, so it is fetched on the cached
+    # connection and encoded in one go rather than streamed.
+    rows = read_connection().execute(
+        f"""
+        SELECT id, guid, title, created_at, updated_at, {"tags_json," if include_tags else ""}
+            source_file, resource_count, COALESCE(updated_at, created_at, 0) AS sort_key
+        FROM notes
+        {where}
+        ORDER BY COALESCE(updated_at, created_at, 0) DESC, id DESC
+        LIMIT ? OFFSET ?
+        """,
+        params + [limit, offset],
+    ).fetchall()
+    next_cursor = f"{rows[-1]['sort_key']}:{rows[-1]['id']}" if len(rows) == limit else None
+    # Returned as a response so FastAPI goes straight to orjson without re-encoding the dicts.
+    return OrjsonResponse(
+        {"notes": [list_item_from_row(row, include_tags) for row in rows], "next_cursor": next_cursor}
+    )
 
 
 @app.get("/api/search")
@@ -88,8 +143,7 @@ def search_notes(q: str, limit: int = 50, offset: int = 0) -> dict:
     if not query:
         raise HTTPException(status_code=400, detail="Query cannot be empty")
 
-    conn = db.get_connection()
-    cur = conn.cursor()
+    cur = read_connection().cursor()
     try:
         if limit and limit > 0:
             cur.execute(
@@ -115,18 +169,15 @@ def search_notes(q: str, limit: int = 50, offset: int = 0) -> dict:
                 (query,),
             )
     except sqlite3.OperationalError:
-        conn.close()
         raise HTTPException(status_code=400, detail="Invalid search query")
 
     rows = cur.fetchall()
-    conn.close()
     return {"notes": [note_from_row(row) for row in rows]}
 
 
 @app.get("/api/notes/{note_id}")
 def get_note(note_id: int) -> dict:
-    conn = db.get_connection()
-    cur = conn.cursor()
+    cur = read_connection().cursor()
     cur.execute(
         """
         SELECT id, guid, title, created_at, updated_at, tags_json, html, text, source_file
@@ -136,12 +187,11 @@ def get_note(note_id: int) -> dict:
     )
     row = cur.fetchone()
     if not row:
-        conn.close()
         raise HTTPException(status_code=404, detail="Note not found")
 
     cur.execute(
         """
-        SELECT id, mime, filename, length(data) AS size
+        SELECT id, mime, filename, size
         FROM resources WHERE note_id = ?
         """,
         (note_id,),
@@ -167,54 +217,54 @@ def get_note(note_id: int) -> dict:
         "source_file": row["source_file"],
         "resources": resources,
     }
-    conn.close()
     return note
 
 
 @app.get("/api/notes/{note_id}/attachments/{resource_id}")
 def download_attachment(note_id: int, resource_id: int):
-    conn = db.get_connection()
-    cur = conn.cursor()
+    cur = read_connection().cursor()
     cur.execute(
         """
-        SELECT data, filename, mime FROM resources
+        SELECT path, filename, mime FROM resources
         WHERE id = ? AND note_id = ?
         """,
         (resource_id, note_id),
     )
     row = cur.fetchone()
-    conn.close()
-    if not row:
+    if not row or not row["path"]:
         raise HTTPException(status_code=404, detail="Attachment not found")
-    data = row["data"]
+    path = db.attachment_path(row["path"])
+    if not path.is_file():
+        raise HTTPException(status_code=404, detail="Attachment file missing")
     filename = row["filename"] or f"attachment-{resource_id}"
     mime = row["mime"] or "application/octet-stream"
-    return FileResponse(
-        path=_write_temp_file(data, filename),
-        media_type=mime,
-        filename=filename,
-    )
-
-
-def _write_temp_file(data: bytes, filename: str) -> str:
-    tmp = NamedTemporaryFile(delete=False)
-    tmp.write(data)
-    tmp.flush()
-    tmp.close()
-    return tmp.name
+    return FileResponse(path=path, media_type=mime, filename=filename)
 
 
 def json_load(raw: Optional[str]) -> list:
     if not raw:
         return []
     try:
-        import json
-
-        return json.loads(raw)
+        return orjson.loads(raw)
     except Exception:
         return []
 
 
+def list_item_from_row(row, include_tags: bool) -> dict:
+    item = {
+        "id": row["id"],
+        "guid": row["guid"],
+        "title": row["title"],
+        "created_at": row["created_at"],
+        "updated_at": row["updated_at"],
+        "source_file": row["source_file"],
+        "resource_count": row["resource_count"],
+    }
+    if include_tags:
+        item["tags"] = json_load(row["tags_json"])
+    return item
+
+
 def note_from_row(row) -> dict:
     return {
         "id": row["id"],